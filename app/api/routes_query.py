@@ -1,30 +1,181 @@
+import asyncio
+import time
+from typing import List, Optional, Tuple
+
 from fastapi import APIRouter, HTTPException
 from app.schemas.query import QueryRequest, QueryResponse
-from app.core.rag_engine import get_rag
+from app.core.rag_engine import get_rag, gemini_complete_limited, extract_keywords
+from app.core.settings import settings
 from app.core.logging import get_logger
 from lightrag import QueryParam
+from lightrag.prompt import PROMPTS
 
 logger = get_logger(__name__)
 router = APIRouter()
 
+# Cheaper mode to try when retrieval runs over its share of the deadline.
+# Keywords are extracted once and reused, so falling back never re-runs the LLM.
+MODE_FALLBACKS = {
+    "hybrid": "local",
+    "global": "naive",
+    "local": "naive",
+}
+
+# Separator LightRAG puts between the system prompt and the question with only_need_prompt=True
+USER_QUERY_SEPARATOR = "\n\n---User Query---\n\n"
+
+def _degradation_chain(mode: str) -> List[str]:
+    chain = [mode]
+    while chain[-1] in MODE_FALLBACKS:
+        chain.append(MODE_FALLBACKS[chain[-1]])
+    return chain
+
+def _extract_answer(result) -> str:
+    if isinstance(result, str):
+        return result
+    if isinstance(result, dict) and 'answer' in result:
+        return result['answer']
+    return str(result)
+
+def _log_stage(stage: str, mode: str, started: float, budget: float, deadline_ms: int, timed_out: bool):
+    logger.info(
+        "query_stage",
+        stage=stage,
+        mode=mode,
+        elapsed_ms=round((time.monotonic() - started) * 1000),
+        budget_ms=round(budget * 1000),
+        deadline_ms=deadline_ms,
+        timed_out=timed_out,
+    )
+
+def _retrieved_prompt(result: dict) -> Optional[str]:
+    # None means LightRAG found no context and would answer with PROMPTS["fail_response"]
+    content = result.get("llm_response", {}).get("content")
+    if result.get("status") == "failure":
+        if result.get("metadata", {}).get("failure_reason") == "no_results":
+            return None
+        # aquery_llm reports its own exceptions as a failure result
+        raise RuntimeError(result.get("message", "Query retrieval failed"))
+    if content == PROMPTS["fail_response"]:
+        return None
+    return content
+
+async def _keywords_within_deadline(request: QueryRequest, deadline: float) -> Tuple[List[str], List[str]]:
+    budget = (deadline - time.monotonic()) * settings.query_stage_budget_ratio
+    started = time.monotonic()
+    try:
+        async with asyncio.timeout(budget) as stage_timeout:
+            hl_keywords, ll_keywords = await extract_keywords(request.question, request.mode)
+    except TimeoutError:
+        if not stage_timeout.expired():
+            raise
+        _log_stage("keywords", request.mode, started, budget, request.deadline_ms, timed_out=True)
+        return [], []
+
+    _log_stage("keywords", request.mode, started, budget, request.deadline_ms, timed_out=False)
+    return hl_keywords, ll_keywords
+
+async def _retrieve_within_deadline(rag, request: QueryRequest, chain: List[str], keywords: Tuple[List[str], List[str]], deadline: float) -> Tuple[Optional[str], str]:
+    hl_keywords, ll_keywords = keywords
+
+    # Retrieval only: LightRAG returns the rendered prompt without calling the LLM for the answer
+    for mode in chain:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+
+        # Each stage leaves part of the budget for its fallbacks and for generation
+        budget = remaining * settings.query_stage_budget_ratio
+        started = time.monotonic()
+        try:
+            async with asyncio.timeout(budget) as stage_timeout:
+                result = await rag.aquery_llm(
+                    request.question,
+                    param=QueryParam(
+                        mode=mode,
+                        only_need_prompt=True,
+                        hl_keywords=hl_keywords,
+                        ll_keywords=ll_keywords,
+                    )
+                )
+        except TimeoutError:
+            # A timeout raised by the storage or LLM client is a failure, not a budget overrun
+            if not stage_timeout.expired():
+                raise
+            _log_stage("retrieval", mode, started, budget, request.deadline_ms, timed_out=True)
+            continue
+
+        _log_stage("retrieval", mode, started, budget, request.deadline_ms, timed_out=False)
+        return _retrieved_prompt(result), mode
+
+    raise HTTPException(
+        status_code=504,
+        detail=f"Query retrieval exceeded deadline of {request.deadline_ms}ms"
+    )
+
+async def _generate_within_deadline(prompt: str, mode: str, request: QueryRequest, deadline: float) -> str:
+    system_prompt, _, question = prompt.rpartition(USER_QUERY_SEPARATOR)
+
+    budget = deadline - time.monotonic()
+    started = time.monotonic()
+    try:
+        async with asyncio.timeout(budget) as stage_timeout:
+            result = await gemini_complete_limited(
+                question,
+                system_prompt=system_prompt or None,
+                enable_cot=True,
+            )
+    except TimeoutError:
+        if not stage_timeout.expired():
+            raise
+        _log_stage("generation", mode, started, budget, request.deadline_ms, timed_out=True)
+        raise HTTPException(
+            status_code=504,
+            detail=f"Query generation exceeded deadline of {request.deadline_ms}ms"
+        )
+
+    _log_stage("generation", mode, started, budget, request.deadline_ms, timed_out=False)
+    return _extract_answer(result)
+
+async def _query_within_deadline(rag, request: QueryRequest) -> Tuple[str, str]:
+    deadline = time.monotonic() + request.deadline_ms / 1000
+
+    chain = _degradation_chain(request.mode)
+    hl_keywords, ll_keywords = [], []
+    if request.mode != "naive":
+        hl_keywords, ll_keywords = await _keywords_within_deadline(request, deadline)
+        if not hl_keywords and not ll_keywords:
+            # LightRAG would extract them again in its worker pool, so only
+            # naive retrieval (which needs none) is left
+            chain = ["naive"]
+
+    prompt, mode = await _retrieve_within_deadline(rag, request, chain, (hl_keywords, ll_keywords), deadline)
+    if mode != request.mode:
+        logger.info("query_degraded", requested_mode=request.mode, served_mode=mode, deadline_ms=request.deadline_ms)
+
+    if prompt is None:
+        return PROMPTS["fail_response"], mode
+
+    answer = await _generate_within_deadline(prompt, mode, request, deadline)
+    return answer, mode
+
 @router.post("/query", response_model=QueryResponse, tags=["Query"])
 async def query_rag(request: QueryRequest):
     try:
         rag = get_rag()
-        
-        result = await rag.aquery(
-            request.question,
-            param=QueryParam(mode=request.mode)
-        )
-        
-        if isinstance(result, str):
-            answer = result
-        elif isinstance(result, dict) and 'answer' in result:
-            answer = result['answer']
+
+        if request.deadline_ms is None:
+            result = await rag.aquery(
+                request.question,
+                param=QueryParam(mode=request.mode)
+            )
+            answer, mode = _extract_answer(result), request.mode
         else:
-            answer = str(result)
-            
-        return QueryResponse(answer=answer)
+            answer, mode = await _query_within_deadline(rag, request)
+
+        return QueryResponse(answer=answer, mode=mode)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error("Query failed", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
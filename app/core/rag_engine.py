@@ -1,8 +1,11 @@
+import asyncio
 import os
-from typing import Optional
+from dataclasses import asdict
+from typing import List, Optional, Tuple
 
-from lightrag import LightRAG
+from lightrag import LightRAG, QueryParam
 from lightrag.llm.gemini import gemini_model_complete, gemini_embed
+from lightrag.operate import extract_keywords_only
 from lightrag.utils import EmbeddingFunc
 
 from app.core.settings import settings
@@ -12,6 +15,7 @@ logger = get_logger(__name__)
 
 # Global singletons
 _rag_instance: Optional[LightRAG] = None
+_llm_semaphore: Optional[asyncio.Semaphore] = None
 
 async def init_rag_engine() -> LightRAG:
     global _rag_instance
@@ -58,7 +62,7 @@ async def init_rag_engine() -> LightRAG:
         workspace=settings.lightrag_workspace,
         llm_model_func=gemini_model_complete,
         llm_model_name=settings.gemini_llm_model,
-        llm_model_max_async=2, # Limit concurrency to survive Gemini Free Tier RPM (15)
+        llm_model_max_async=settings.llm_model_max_async, # Limit concurrency to survive Gemini Free Tier RPM (15)
         embedding_func=embedding_func,
         embedding_batch_num=16,
         embedding_func_max_async=2, # Limit concurrency to survive Gemini Free Tier RPM (15) # Limit concurrency
@@ -76,3 +80,25 @@ def get_rag() -> LightRAG:
     if _rag_instance is None:
         raise RuntimeError("LightRAG is not initialized")
     return _rag_instance
+
+# Calls Gemini in the caller's task so cancelling the caller cancels the request;
+# LightRAG's worker pool keeps running calls whose caller was cancelled.
+async def gemini_complete_limited(prompt: str, **kwargs) -> str:
+    global _llm_semaphore
+
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(settings.llm_model_max_async)
+
+    async with _llm_semaphore:
+        return await gemini_model_complete(prompt, model_name=settings.gemini_llm_model, **kwargs)
+
+# Extracts (high_level, low_level) keywords once so deadline queries can reuse them
+# across modes via QueryParam.hl_keywords / ll_keywords; shares LightRAG's keyword cache.
+async def extract_keywords(question: str, mode: str) -> Tuple[List[str], List[str]]:
+    rag = get_rag()
+    return await extract_keywords_only(
+        question,
+        QueryParam(mode=mode, model_func=gemini_complete_limited),
+        asdict(rag),
+        hashing_kv=rag.llm_response_cache,
+    )
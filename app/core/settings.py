@@ -1,3 +1,4 @@
+from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 
@@ -20,6 +21,13 @@ class Settings(BaseSettings):
     max_upload_mb: int = 100
     ingest_concurrency: int = 2
     
+    # Max concurrent Gemini calls; sizes both LightRAG's worker pool and the
+    # limiter on the direct calls deadline queries make (rag_engine.gemini_complete_limited)
+    llm_model_max_async: int = 2
+    
+    # Share of the remaining deadline a query stage may use before falling back
+    query_stage_budget_ratio: float = Field(default=0.5, gt=0, lt=1)
+    
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
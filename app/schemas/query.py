@@ -1,10 +1,14 @@
 from pydantic import BaseModel, Field
 from typing import Optional, Literal
 
+QueryMode = Literal["hybrid", "local", "global", "naive"]
+
 class QueryRequest(BaseModel):
     question: str
-    mode: Literal["hybrid", "local", "global", "naive"] = "hybrid"
+    mode: QueryMode = "hybrid"
     top_k: Optional[int] = Field(default=None, ge=1)
+    deadline_ms: Optional[int] = Field(default=None, ge=1)
     
 class QueryResponse(BaseModel):
     answer: str
+    mode: QueryMode
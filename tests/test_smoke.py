@@ -1,6 +1,9 @@
+import asyncio
+import contextlib
 import pytest
 import os
 import sys
+from types import SimpleNamespace
 from unittest.mock import patch, AsyncMock, MagicMock
 
 # Ensure the root of the project is in the Python path
@@ -11,6 +14,8 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 sys.modules['lightrag'] = MagicMock()
 sys.modules['lightrag.llm'] = MagicMock()
 sys.modules['lightrag.llm.gemini'] = MagicMock()
+sys.modules['lightrag.operate'] = MagicMock()
+sys.modules['lightrag.prompt'] = MagicMock()
 sys.modules['lightrag.utils'] = MagicMock()
 # --- END MOCKING ---
 
@@ -45,4 +50,177 @@ def test_query_mock():
             }
         )
         assert response.status_code == 200
-        assert response.json() == {"answer": "Mocked text answer"}
+        assert response.json() == {"answer": "Mocked text answer", "mode": "hybrid"}
+
+FAIL_RESPONSE = "Sorry, I'm not able to provide an answer to that question.[no-context]"
+SLOW = 0.15  # Just past the deadlines used below
+
+def retrieval_result(mode):
+    # Shape of LightRAG's aquery_llm result with only_need_prompt=True
+    return {
+        "status": "success",
+        "message": "Query executed successfully",
+        "data": {},
+        "metadata": {"query_mode": mode},
+        "llm_response": {
+            "content": f"system prompt for {mode}\n\n---User Query---\n\ntest?",
+            "response_iterator": None,
+            "is_streaming": False,
+        },
+    }
+
+def no_context_result(mode):
+    return {
+        "status": "failure",
+        "message": "Query returned no results",
+        "data": {},
+        "metadata": {"failure_reason": "no_results", "mode": mode},
+        "llm_response": {"content": FAIL_RESPONSE, "response_iterator": None, "is_streaming": False},
+    }
+
+def slow_in(*slow_modes):
+    async def retrieve(question, param):
+        assert param.only_need_prompt
+        if param.mode in slow_modes:
+            await asyncio.sleep(SLOW)
+        return retrieval_result(param.mode)
+    return retrieve
+
+async def fast_generate(question, system_prompt, enable_cot):
+    return f"answer from {system_prompt}"
+
+@contextlib.contextmanager
+def mock_deadline_query(retrieve, generate=fast_generate, keywords=(["theme"], ["entity"])):
+    """Patch the RAG engine and Gemini so each stage can be slowed down or made to fail."""
+    async def extract(question, mode):
+        if keywords is None:
+            await asyncio.sleep(SLOW)
+        return keywords
+
+    with patch("app.api.routes_query.get_rag") as mock_get_rag, \
+         patch("app.api.routes_query.QueryParam", side_effect=lambda **kwargs: SimpleNamespace(**kwargs)), \
+         patch("app.api.routes_query.PROMPTS", {"fail_response": FAIL_RESPONSE}), \
+         patch("app.api.routes_query.extract_keywords", AsyncMock(side_effect=extract)) as mock_extract, \
+         patch("app.api.routes_query.gemini_complete_limited", AsyncMock(side_effect=generate)) as mock_complete:
+
+        mock_rag_instance = MagicMock()
+        mock_rag_instance.aquery_llm = AsyncMock(side_effect=retrieve)
+        mock_get_rag.return_value = mock_rag_instance
+
+        yield SimpleNamespace(rag=mock_rag_instance, extract=mock_extract, complete=mock_complete)
+
+def post_query(mode, deadline_ms):
+    return client.post(
+        "/api/v1/query",
+        json={
+            "question": "test?",
+            "mode": mode,
+            "deadline_ms": deadline_ms
+        }
+    )
+
+def retrieved_modes(mocks):
+    return [call.kwargs["param"].mode for call in mocks.rag.aquery_llm.await_args_list]
+
+def test_query_deadline_met_without_fallback():
+    with mock_deadline_query(slow_in()) as mocks:
+        response = post_query("hybrid", 500)
+
+        assert response.status_code == 200
+        assert response.json() == {"answer": "answer from system prompt for hybrid", "mode": "hybrid"}
+        assert retrieved_modes(mocks) == ["hybrid"]
+        mocks.complete.assert_awaited_once_with("test?", system_prompt="system prompt for hybrid", enable_cot=True)
+
+def test_query_deadline_falls_back_hybrid_to_local():
+    with mock_deadline_query(slow_in("hybrid")) as mocks:
+        response = post_query("hybrid", 200)
+
+        assert response.status_code == 200
+        assert response.json() == {"answer": "answer from system prompt for local", "mode": "local"}
+        assert retrieved_modes(mocks) == ["hybrid", "local"]
+        # Keywords are extracted once and reused by the fallback
+        assert mocks.extract.await_count == 1
+        for call in mocks.rag.aquery_llm.await_args_list:
+            assert call.kwargs["param"].hl_keywords == ["theme"]
+            assert call.kwargs["param"].ll_keywords == ["entity"]
+
+def test_query_deadline_falls_back_global_to_naive():
+    with mock_deadline_query(slow_in("global")) as mocks:
+        response = post_query("global", 200)
+
+        assert response.status_code == 200
+        assert response.json() == {"answer": "answer from system prompt for naive", "mode": "naive"}
+        assert retrieved_modes(mocks) == ["global", "naive"]
+
+def test_query_deadline_slow_keywords_skip_to_naive():
+    with mock_deadline_query(slow_in(), keywords=None) as mocks:
+        response = post_query("hybrid", 200)
+
+        assert response.status_code == 200
+        assert response.json()["mode"] == "naive"
+        assert retrieved_modes(mocks) == ["naive"]
+
+def test_query_deadline_no_context_skips_generation():
+    async def retrieve(question, param):
+        return no_context_result(param.mode)
+
+    with mock_deadline_query(retrieve) as mocks:
+        response = post_query("hybrid", 500)
+
+        assert response.status_code == 200
+        assert response.json() == {"answer": FAIL_RESPONSE, "mode": "hybrid"}
+        mocks.complete.assert_not_awaited()
+
+def test_query_deadline_exceeded_in_retrieval():
+    with mock_deadline_query(slow_in("hybrid", "local", "naive")):
+        response = post_query("hybrid", 100)
+
+        assert response.status_code == 504
+
+def test_query_deadline_cancels_slow_generation():
+    cancelled = []
+
+    async def slow_generate(question, system_prompt, enable_cot):
+        try:
+            await asyncio.sleep(SLOW)
+        except asyncio.CancelledError:
+            cancelled.append(system_prompt)
+            raise
+        return "too late"
+
+    with mock_deadline_query(slow_in(), slow_generate) as mocks:
+        response = post_query("hybrid", 100)
+
+        assert response.status_code == 504
+        assert cancelled == ["system prompt for hybrid"]
+        # A slow answer must not trigger a cheaper retrieval
+        assert retrieved_modes(mocks) == ["hybrid"]
+
+def test_query_deadline_stage_error_does_not_fall_back():
+    async def failing_retrieve(question, param):
+        raise TimeoutError("Milvus client timeout")
+
+    with mock_deadline_query(failing_retrieve) as mocks:
+        response = post_query("hybrid", 500)
+
+        assert response.status_code == 500
+        assert retrieved_modes(mocks) == ["hybrid"]
+        mocks.complete.assert_not_awaited()
+
+def test_query_deadline_reported_failure_does_not_fall_back():
+    async def failing_retrieve(question, param):
+        # aquery_llm catches its own exceptions and reports them like this
+        return {
+            "status": "failure",
+            "message": "Query failed: graph storage unavailable",
+            "data": {},
+            "metadata": {},
+            "llm_response": {"content": None, "response_iterator": None, "is_streaming": False},
+        }
+
+    with mock_deadline_query(failing_retrieve) as mocks:
+        response = post_query("hybrid", 500)
+
+        assert response.status_code == 500
+        assert retrieved_modes(mocks) == ["hybrid"]
+        mocks.complete.assert_not_awaited()